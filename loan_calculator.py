@@ -1,7 +1,42 @@
 import streamlit as st
 import pandas as pd
-import plotly.graph_objects as go
-from io import BytesIO
+import numpy as np
+from functools import lru_cache
+
+
+def format_currency(series):
+    """
+    Formatea una columna numérica como moneda (L.1,234.56).
+    
+    Args:
+        series (pd.Series): Valores numéricos
+    
+    Returns:
+        pd.Series: Valores formateados como texto
+    """
+    return 'L.' + series.map('{:,.2f}'.format)
+
+
+@lru_cache(maxsize=128)
+def _payment_terms(principal, annual_rate, months):
+    """
+    Calcula la cuota mensual junto con la tasa mensual y el factor (1+r)^n.
+    
+    Args:
+        principal (float): Monto del préstamo
+        annual_rate (float): Tasa de interés anual (%)
+        months (int): Plazo en meses
+    
+    Returns:
+        tuple: (cuota mensual, tasa mensual, factor (1+r)^n)
+    """
+    if annual_rate == 0:
+        return principal / months, 0.0, 1.0
+    
+    monthly_rate = annual_rate / 100 / 12
+    factor = (1 + monthly_rate) ** months
+    payment = principal * monthly_rate * factor / (factor - 1)
+    return payment, monthly_rate, factor
 
 
 def calculate_monthly_payment(principal, annual_rate, months):
@@ -18,14 +53,10 @@ def calculate_monthly_payment(principal, annual_rate, months):
     Returns:
         float: Cuota mensual
     """
-    if annual_rate == 0:
-        return principal / months
-    
-    monthly_rate = annual_rate / 100 / 12
-    payment = principal * (monthly_rate * (1 + monthly_rate)**months) / ((1 + monthly_rate)**months - 1)
-    return payment
+    return _payment_terms(principal, annual_rate, months)[0]
 
 
+@st.cache_data(max_entries=32)
 def generate_amortization_schedule(principal, annual_rate, months):
     """
     Genera la tabla de amortización completa del préstamo.
@@ -43,52 +74,63 @@ def generate_amortization_schedule(principal, annual_rate, months):
                      - Interés: Interés pagado
                      - Saldo: Saldo restante
     """
-    monthly_payment = calculate_monthly_payment(principal, annual_rate, months)
-    monthly_rate = annual_rate / 100 / 12
+    monthly_payment, monthly_rate, factor = _payment_terms(principal, annual_rate, months)
     
-    schedule = []
-    remaining_balance = principal
+    payment_numbers = np.arange(1, months + 1)
     
-    for payment_number in range(1, months + 1):
-        interest_payment = remaining_balance * monthly_rate
-        # Capital
-        principal_payment = monthly_payment - interest_payment
-
-        if payment_number == months:
-            principal_payment = remaining_balance
-            monthly_payment = principal_payment + interest_payment
-        
-        # Actualiza saldo
-        remaining_balance -= principal_payment
-        
-        # Agrega fila al cronograma
-        schedule.append({
-            'Pago': payment_number,
-            'Cuota': monthly_payment,
-            'Capital': principal_payment,
-            'Interés': interest_payment,
-            'Saldo': max(0, remaining_balance)  # Evita saldos negativos por redondeo
-        })
-    
-    return pd.DataFrame(schedule)
+    # Saldo después de cada pago (forma cerrada):
+    # B_k = P*(1+r)^k - C*((1+r)^k - 1)/r = P * ((1+r)^n - (1+r)^k) / ((1+r)^n - 1)
+    # La segunda forma evita restar dos cantidades enormes en plazos largos.
+    if annual_rate == 0:
+        balance = principal - monthly_payment * payment_numbers
+    else:
+        growth = (1 + monthly_rate) ** payment_numbers
+        balance = principal * (factor - growth) / (factor - 1)
+    
+    # Saldo al inicio de cada periodo
+    previous_balance = np.concatenate(([principal], balance[:-1]))
+    interest_payments = previous_balance * monthly_rate
+    # Capital
+    principal_payments = monthly_payment - interest_payments
+    payments = np.full(months, monthly_payment)
+    
+    # El último pago liquida el saldo residual
+    principal_payments[-1] = previous_balance[-1]
+    payments[-1] = principal_payments[-1] + interest_payments[-1]
+    balance[-1] = 0.0
+    
+    return pd.DataFrame({
+        'Pago': payment_numbers,
+        'Cuota': payments,
+        'Capital': principal_payments,
+        'Interés': interest_payments,
+        'Saldo': np.maximum(balance, 0)  # Evita saldos negativos por redondeo
+    })
 
 
+@st.cache_data(max_entries=32)
 def create_balance_evolution_chart(df):
     """
     Crea gráfica de evolución del saldo pendiente.
     
+    Para plazos mayores a 60 meses se omiten los marcadores de cada pago.
+    
     Args:
         df (pd.DataFrame): Tabla de amortización
     
     Returns:
         plotly.graph_objects.Figure: Gráfica de línea del saldo
     """
+    import plotly.graph_objects as go
+    
+    mode = 'lines+markers' if len(df) <= 60 else 'lines'
+    
     fig = go.Figure()
     
-    fig.add_trace(go.Scatter(
+    fig.add_trace(go.Scattergl(
         x=df['Pago'],
         y=df['Saldo'],
-        mode='lines+markers',
+        mode=mode,
         name='Saldo Pendiente',
         line=dict(color='#1f77b4', width=3),
         marker=dict(size=6)
@@ -105,35 +147,47 @@ def create_balance_evolution_chart(df):
     return fig
 
 
+@st.cache_data(max_entries=32)
 def create_payment_composition_chart(df):
     """
     Crea gráfica de proporción capital vs intereses.
     
+    Para plazos mayores a 60 meses agrupa los pagos por año.
+    
     Args:
         df (pd.DataFrame): Tabla de amortización
     
     Returns:
         plotly.graph_objects.Figure: Gráfica de barras apiladas
     """
+    import plotly.graph_objects as go
+    
+    if len(df) > 60:
+        composition = df.groupby((df['Pago'] - 1) // 12 + 1)[['Capital', 'Interés']].sum()
+        xaxis_title = 'Año'
+    else:
+        composition = df.set_index('Pago')[['Capital', 'Interés']]
+        xaxis_title = 'Número de Pago'
+    
     fig = go.Figure()
     
     fig.add_trace(go.Bar(
-        x=df['Pago'],
-        y=df['Capital'],
+        x=composition.index,
+        y=composition['Capital'],
         name='Capital',
         marker_color='#2ca02c'
     ))
     
     fig.add_trace(go.Bar(
-        x=df['Pago'],
-        y=df['Interés'],
+        x=composition.index,
+        y=composition['Interés'],
         name='Interés',
         marker_color='#ff7f0e'
     ))
     
     fig.update_layout(
         title='Composición de Pagos: Capital vs Interés',
-        xaxis_title='Número de Pago',
+        xaxis_title=xaxis_title,
         yaxis_title='Monto ($)',
         barmode='stack',
         hovermode='x unified',
@@ -143,22 +197,26 @@ def create_payment_composition_chart(df):
     return fig
 
 
-def export_to_excel(df, principal, annual_rate, months):
+@st.cache_data(max_entries=32)
+def export_to_excel(df, totals, principal, annual_rate, months):
     """
     Exporta la tabla de amortización a Excel.
     
     Args:
         df (pd.DataFrame): Tabla de amortización
+        totals (pd.Series): Sumas de las columnas 'Cuota' e 'Interés'
         principal (float): Monto del préstamo
         annual_rate (float): Tasa de interés anual
         months (int): Plazo en meses
     
     Returns:
-        BytesIO: Archivo Excel en memoria
+        bytes: Contenido del archivo Excel
     """
+    from io import BytesIO
+    
     output = BytesIO()
     
-    with pd.ExcelWriter(output, engine='openpyxl') as writer:
+    with pd.ExcelWriter(output, engine='xlsxwriter') as writer:
         # Crea hoja de resumen
         summary_data = {
             'Concepto': [
@@ -174,22 +232,33 @@ def export_to_excel(df, principal, annual_rate, months):
                 f"{annual_rate}%",
                 months,
                 f"L.{df['Cuota'].iloc[0]:,.2f}",
-                f"L.{df['Cuota'].sum():,.2f}",
-                f"L.{df['Interés'].sum():,.2f}"
+                f"L.{totals['Cuota']:,.2f}",
+                f"L.{totals['Interés']:,.2f}"
             ]
         }
         summary_df = pd.DataFrame(summary_data)
         summary_df.to_excel(writer, sheet_name='Resumen', index=False)
         
-        # Crea tabla de amortización
-        df_formatted = df.copy()
-        for col in ['Cuota', 'Capital', 'Interés', 'Saldo']:
-            df_formatted[col] = df_formatted[col].apply(lambda x: f"L.{x:,.2f}")
-        
-        df_formatted.to_excel(writer, sheet_name='Tabla de Amortización', index=False)
+        # Crea tabla de amortización (valores numéricos con formato de moneda)
+        df.to_excel(writer, sheet_name='Tabla de Amortización', index=False)
+        money_format = writer.book.add_format({'num_format': '"L."#,##0.00'})
+        writer.sheets['Tabla de Amortización'].set_column('B:E', 14, money_format)
+    
+    return output.getvalue()
+
+
+@st.cache_data(max_entries=32)
+def export_to_csv(df):
+    """
+    Exporta la tabla de amortización a CSV.
+    
+    Args:
+        df (pd.DataFrame): Tabla de amortización
     
-    output.seek(0)
-    return output
+    Returns:
+        bytes: Contenido del archivo CSV (UTF-8)
+    """
+    return df.to_csv(index=False).encode('utf-8')
 
 
 def main():
@@ -250,8 +319,21 @@ def main():
         # Calcula cuota mensual
         monthly_payment = calculate_monthly_payment(principal, annual_rate, months)
         
-        # Genera tabla de amortización
-        df = generate_amortization_schedule(principal, annual_rate, months)
+        # Genera tabla, gráficas y archivos solo si cambiaron los parámetros
+        params = (principal, annual_rate, months)
+        if st.session_state.get('params') != params:
+            df = generate_amortization_schedule(principal, annual_rate, months)
+            totals = df[['Cuota', 'Interés']].sum()
+            st.session_state['params'] = params
+            st.session_state['df'] = df
+            st.session_state['totals'] = totals
+            st.session_state['fig_balance'] = create_balance_evolution_chart(df)
+            st.session_state['fig_comp'] = create_payment_composition_chart(df)
+            st.session_state['excel_bytes'] = export_to_excel(df, totals, principal, annual_rate, months)
+            st.session_state['csv_bytes'] = export_to_csv(df)
+        
+        df = st.session_state['df']
+        totals = st.session_state['totals']
         
         # Resultados principales
         col1, col2, col3, col4 = st.columns(4)
@@ -263,10 +345,10 @@ def main():
             st.metric("💳 Cuota Mensual", f"L.{monthly_payment:,.2f}")
         
         with col3:
-            st.metric("💸 Total a Pagar", f"L.{df['Cuota'].sum():,.2f}")
+            st.metric("💸 Total a Pagar", f"L.{totals['Cuota']:,.2f}")
         
         with col4:
-            st.metric("📊 Total Intereses", f"L.{df['Interés'].sum():,.2f}")
+            st.metric("📊 Total Intereses", f"L.{totals['Interés']:,.2f}")
         
         st.markdown("---")
         
@@ -276,12 +358,10 @@ def main():
         with tab1:
             st.subheader("📋 Plan de Pagos Detallado")
             
-            # Formatear para mostrar
-            df_display = df.copy()
-            df_display['Cuota'] = df_display['Cuota'].apply(lambda x: f"L.{x:,.2f}")
-            df_display['Capital'] = df_display['Capital'].apply(lambda x: f"L.{x:,.2f}")
-            df_display['Interés'] = df_display['Interés'].apply(lambda x: f"L.{x:,.2f}")
-            df_display['Saldo'] = df_display['Saldo'].apply(lambda x: f"L.{x:,.2f}")
+            # Formatear para mostrar (sin copiar la tabla numérica)
+            df_display = pd.DataFrame({'Pago': df['Pago']})
+            for col in ['Cuota', 'Capital', 'Interés', 'Saldo']:
+                df_display[col] = format_currency(df[col])
             
             # Mostrar tabla
             st.dataframe(
@@ -302,7 +382,7 @@ def main():
             
             # Gráfica de evolución del saldo
             st.plotly_chart(
-                create_balance_evolution_chart(df),
+                st.session_state['fig_balance'],
                 use_container_width=True
             )
             
@@ -310,7 +390,7 @@ def main():
             
             # Gráfica de composición de pagos
             st.plotly_chart(
-                create_payment_composition_chart(df),
+                st.session_state['fig_comp'],
                 use_container_width=True
             )
         
@@ -321,20 +401,18 @@ def main():
             
             with col1:
                 st.markdown("#### 📊 Descargar como Excel")
-                excel_file = export_to_excel(df, principal, annual_rate, months)
                 st.download_button(
                     label="⬇️ Descargar Excel",
-                    data=excel_file,
+                    data=st.session_state['excel_bytes'],
                     file_name=f"amortizacion_prestamo_{principal:.0f}.xlsx",
                     mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
                 )
             
             with col2:
                 st.markdown("#### 📄 Descargar como CSV")
-                csv = df.to_csv(index=False)
                 st.download_button(
                     label="⬇️ Descargar CSV",
-                    data=csv,
+                    data=st.session_state['csv_bytes'],
                     file_name=f"amortizacion_prestamo_{principal:.0f}.csv",
                     mime="text/csv"
                 )